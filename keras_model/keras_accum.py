@@ -0,0 +1,55 @@
+import tensorflow as tf
+from keras import mixed_precision
+from keras.models import Model
+
+
+class GradientAccumulationModel(Model):
+    """Functional model whose train step splits each batch into `accum_steps` micro-batches
+    and sums their gradients before a single optimizer update.
+    The effective batch grows while the activation memory stays at one micro-batch.
+    """
+    def __init__(self, *args, **kwargs):
+        accum_steps = kwargs.pop('accum_steps', 1)
+        super(GradientAccumulationModel, self).__init__(*args, **kwargs)
+        self.accum_steps = accum_steps
+
+    def get_config(self):
+        # Subclassed models only report their name, take the layer graph from a plain functional view
+        config = Model(inputs=self.inputs, outputs=self.outputs, name=self.name).get_config()
+        config['accum_steps'] = self.accum_steps
+        return config
+
+    @classmethod
+    def from_config(cls, config, custom_objects=None):
+        config = dict(config)
+        accum_steps = config.pop('accum_steps', 1)
+        model = Model.from_config(config, custom_objects=custom_objects)
+        return cls(inputs=model.inputs, outputs=model.outputs, name=model.name, accum_steps=accum_steps)
+
+    def train_step(self, data):
+        x, y = data
+        scale_loss = isinstance(self.optimizer, mixed_precision.LossScaleOptimizer)
+        x = tf.reshape(x, [self.accum_steps, -1] + x.shape[1:].as_list())
+        y = tf.reshape(y, [self.accum_steps, -1] + y.shape[1:].as_list())
+
+        def accumulate(i, accum_grads):
+            with tf.GradientTape() as tape:
+                y_pred = self(x[i], training=True)
+                loss = self.compiled_loss(y[i], y_pred, regularization_losses=self.losses)
+                loss = loss / self.accum_steps
+                if scale_loss:
+                    loss = self.optimizer.get_scaled_loss(loss)
+            grads = tape.gradient(loss, self.trainable_variables)
+            self.compiled_metrics.update_state(y[i], y_pred)
+            return i + 1, [acc + grad for acc, grad in zip(accum_grads, grads)]
+
+        # A while loop keeps one micro-batch of activations in the graph and, unlike an unrolled
+        # python loop, runs the iterations in order under XLA
+        _, accum_grads = tf.while_loop(
+            lambda i, _: i < self.accum_steps, accumulate,
+            [tf.constant(0), [tf.zeros_like(v) for v in self.trainable_variables]])
+
+        if scale_loss:
+            accum_grads = self.optimizer.get_unscaled_gradients(accum_grads)
+        self.optimizer.apply_gradients(zip(accum_grads, self.trainable_variables))
+        return {m.name: m.result() for m in self.metrics}
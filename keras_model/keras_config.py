@@ -12,6 +12,12 @@ class Config(object):
     parser.add_argument("--backbone", default='xception', type=str)
     parser.add_argument("--lr", default=0.01, type=float)
     parser.add_argument("--out_class", default=8, type=int)
+    parser.add_argument("--accum_steps", default=1, type=int)
+    parser.add_argument("--steps_per_execution", default=1, type=int)
+    parser.add_argument("--cache_dir", default='', type=str)
+    parser.add_argument("--shuffle_buffer", default=1024, type=int)
+    parser.add_argument("--precision", default='mixed_float16', type=str,
+                        choices=['float32', 'mixed_float16', 'mixed_bfloat16'])
     args = parser.parse_args()
     backbone = args.backbone
     out_class = args.out_class
@@ -19,6 +25,11 @@ class Config(object):
     epoch = args.epoch
     lr = args.lr
     gpu_count = args.gpu_count
+    precision = args.precision
+    accum_steps = args.accum_steps
+    cache_dir = args.cache_dir
+    shuffle_buffer = args.shuffle_buffer
+    steps_per_execution = args.steps_per_execution
 
 
 if __name__ == '__main__':
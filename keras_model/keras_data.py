@@ -0,0 +1,83 @@
+import os
+import hashlib
+import tensorflow as tf
+from keras.models import Sequential
+from keras.layers import RandomFlip, RandomRotation, RandomTranslation, RandomZoom
+from keras.utils import image_dataset_from_directory
+
+IMAGE_SIZE = (224, 224)
+AUTOTUNE = tf.data.AUTOTUNE
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+def _augmenter():
+    """Random transforms of the former ImageDataGenerator, kept in float32 whatever the policy.
+    Shear has no keras preprocessing layer and is left out.
+    """
+    return Sequential([
+        RandomFlip('horizontal_and_vertical', dtype='float32'),
+        RandomRotation(10. / 360, fill_mode='reflect', dtype='float32'),
+        RandomTranslation(0.1, 0.1, fill_mode='reflect', dtype='float32'),
+        RandomZoom(0.1, fill_mode='reflect', dtype='float32'),
+    ])
+
+
+def _normalize(x, y):
+    """Dataset level normalization with the ImageNet statistics, folded into the [0, 255] rescale.
+    """
+    return (x / 255. - IMAGENET_MEAN) / IMAGENET_STD, y
+
+
+def _cache_file(directory, file_paths, cache_dir):
+    """Path of the on-disk cache of a split. The name carries the image size and a digest of the
+    normalization and of the file list, so changing any of them builds a new cache instead of
+    silently reading a stale one.
+    """
+    key = repr((os.path.abspath(directory), IMAGE_SIZE, IMAGENET_MEAN, IMAGENET_STD, sorted(file_paths)))
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+    name = '{}_{}x{}_{}.cache'.format(os.path.basename(os.path.normpath(directory)),
+                                      IMAGE_SIZE[0], IMAGE_SIZE[1], digest)
+    cache_file = os.path.join(cache_dir, name)
+    # A run killed during its first epoch leaves a lockfile and partial shards behind, on which
+    # tf.data refuses to write the cache again. The index is only written once the cache is
+    # complete, so without it the leftovers are dropped. Assumes one run per cache_dir at a time.
+    if not tf.io.gfile.exists(cache_file + '.index'):
+        for leftover in tf.io.gfile.glob(cache_file + '_*'):
+            tf.io.gfile.remove(leftover)
+    return cache_file
+
+
+def load_dataset(directory, batch_size, training=False, cache_dir='', shuffle_buffer=1024):
+    """Builds the tf.data pipeline of one split.
+    Args:
+        directory: Folder holding one sub folder per class
+        batch_size: Global batch size
+        training: Shuffle and augment the images if True
+        cache_dir: Folder for an on-disk cache of the normalized images, cached in memory if empty
+        shuffle_buffer: Number of cached images reshuffled together every epoch
+    Returns:
+        A `tf.data.Dataset` of (image, one hot label) batches
+    """
+    # The file order shuffled here is frozen by the cache, it only saves the bounded reshuffle below
+    # from starting on class sorted folders
+    ds = image_dataset_from_directory(directory, label_mode='categorical', color_mode='rgb',
+                                      image_size=IMAGE_SIZE, batch_size=batch_size, shuffle=training)
+    num_images = len(ds.file_paths)
+    # Normalized but not yet augmented images are cached, later epochs skip decoding and normalizing
+    cache_file = _cache_file(directory, ds.file_paths, cache_dir) if cache_dir else ''
+    ds = ds.map(_normalize, num_parallel_calls=AUTOTUNE).unbatch().cache(cache_file)
+    if training:
+        # Bounded: the buffer holds float32 images in host RAM (600 KB each, even with a disk cache)
+        # and is filled before the first batch of every epoch
+        ds = ds.shuffle(buffer_size=min(shuffle_buffer, num_images), reshuffle_each_iteration=True)
+    # Full training batches keep them divisible into the micro-batches of GradientAccumulationModel
+    ds = ds.batch(batch_size, drop_remainder=training)
+    # unbatch loses the size, fit needs it back to run more than one step per execution
+    num_batches = num_images // batch_size if training else -(-num_images // batch_size)
+    ds = ds.apply(tf.data.experimental.assert_cardinality(num_batches))
+    if training:
+        augmenter = _augmenter()
+        # Augment after batching so every op runs once over the whole batch
+        ds = ds.map(lambda x, y: (augmenter(x, training=True), y), num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
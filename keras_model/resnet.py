@@ -1,23 +1,32 @@
 from __future__ import division
 
-import six
-from keras.models import Model
+import numpy as np
+from keras.models import clone_model
+from keras.applications import ResNet50, ResNet101, ResNet152
 from keras.layers import (
     Input,
     Activation,
     Dense,
-    Flatten
+    GlobalAveragePooling2D,
+    Conv2D,
+    MaxPooling2D,
+    BatchNormalization,
+    add
 )
-from keras.layers.convolutional import Conv2D,MaxPooling2D,AveragePooling2D
-from keras.layers import Activation
-from keras.layers.merge import add
-from keras.layers.normalization import BatchNormalization
 from keras.regularizers import l2
 from keras import backend as K
+from keras_accum import GradientAccumulationModel
 from variant_res_module import resnet_convolution_block, resnet_identity_block, xresneXt_convolution_block, xresneXt_identity_block,\
     dresneXt_convolution_block, dresneXt_identity_block
 import os
 
+# Only the NHWC layout is supported, it is the one cuDNN runs on Tensor Cores
+CHANNEL_AXIS = 3
+# Weight decay is applied by the optimizer (decoupled) to the kernels tagged by the conv helpers,
+# see ResnetBuilder.weight_decay_variables, instead of an l2 loss term
+USE_WEIGHT_DECAY_OPTIMIZER = True
+_DEFAULT_L2 = l2(1.e-4)
+
 ROOT_DIR = os.getcwd()
 if ROOT_DIR.endswith('keras_model'):
     ROOT_DIR = os.path.dirname(ROOT_DIR)
@@ -25,7 +34,7 @@ if ROOT_DIR.endswith('keras_model'):
 def _bn_relu(input):
     """Helper to build a BN -> relu block
     """
-    norm = BatchNormalization()(input)
+    norm = BatchNormalization(axis=CHANNEL_AXIS)(input)
     return Activation("relu")(norm)
 
 
@@ -37,14 +46,17 @@ def _conv_bn_relu(**conv_params):
     strides = conv_params.setdefault("strides", (1, 1))
     kernel_initializer = conv_params.setdefault("kernel_initializer", "he_normal")
     padding = conv_params.setdefault("padding", "same")
-    kernel_regularizer = conv_params.setdefault("kernel_regularizer", l2(1.e-4))
+    kernel_regularizer = conv_params.setdefault("kernel_regularizer",
+                                                None if USE_WEIGHT_DECAY_OPTIMIZER else _DEFAULT_L2)
 
     def f(input):
         conv = Conv2D(filters=filters, kernel_size=kernel_size,
                       strides=strides, padding=padding,
                       kernel_initializer=kernel_initializer,
-                      kernel_regularizer=kernel_regularizer)(input)
-        return _bn_relu(conv)
+                      kernel_regularizer=kernel_regularizer)
+        # The optimizer weight decay takes over from the l2 regularizer on this kernel only
+        conv.decay_kernel = USE_WEIGHT_DECAY_OPTIMIZER and kernel_regularizer is None
+        return _bn_relu(conv(input))
 
     return f
 
@@ -58,14 +70,18 @@ def _bn_relu_conv(**conv_params):
     strides = conv_params.setdefault("strides", (1, 1))
     kernel_initializer = conv_params.setdefault("kernel_initializer", "he_normal")
     padding = conv_params.setdefault("padding", "same")
-    kernel_regularizer = conv_params.setdefault("kernel_regularizer", l2(1.e-4))
+    kernel_regularizer = conv_params.setdefault("kernel_regularizer",
+                                                None if USE_WEIGHT_DECAY_OPTIMIZER else _DEFAULT_L2)
 
     def f(input):
         activation = _bn_relu(input)
-        return Conv2D(filters=filters, kernel_size=kernel_size,
+        conv = Conv2D(filters=filters, kernel_size=kernel_size,
                       strides=strides, padding=padding,
                       kernel_initializer=kernel_initializer,
-                      kernel_regularizer=kernel_regularizer)(activation)
+                      kernel_regularizer=kernel_regularizer)
+        # The optimizer weight decay takes over from the l2 regularizer on this kernel only
+        conv.decay_kernel = USE_WEIGHT_DECAY_OPTIMIZER and kernel_regularizer is None
+        return conv(activation)
 
     return f
 
@@ -85,46 +101,55 @@ def _residual_block(input, id_block, conv_block, mid_f, output_f, repetitions, s
 
 
 
-def _get_block(identifier):
-    if isinstance(identifier, six.string_types):
-        res = globals().get(identifier)
-        if not res:
-            raise ValueError('Invalid {}'.format(identifier))
-        return res
-    return identifier
+_KERAS_RESNETS = {50: ResNet50, 101: ResNet101, 152: ResNet152}
+
+# block_fn -> (identity block, convolution block)
+_BLOCK_REGISTRY = {
+    'resnet': (resnet_identity_block, resnet_convolution_block),
+    'xresnet': (xresneXt_identity_block, xresneXt_convolution_block),
+    'dresnet': (dresneXt_identity_block, dresneXt_convolution_block),
+}
+_BLOCK_REGISTRY['xresnext'] = _BLOCK_REGISTRY['xresnet']
+_BLOCK_REGISTRY['dresnext'] = _BLOCK_REGISTRY['dresnet']
+
+
+def _fold_bn(conv, bn):
+    """Helper to fold a BN layer into the kernel and bias of the conv feeding it.
+    W_hat = W * gamma / sqrt(var + eps), b_hat = beta + (b - mean) * gamma / sqrt(var + eps)
+    """
+    weights = conv.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if conv.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    gamma = K.get_value(bn.gamma) if bn.scale else 1.
+    beta = K.get_value(bn.beta) if bn.center else 0.
+    scale = gamma / np.sqrt(K.get_value(bn.moving_variance) + bn.epsilon)
+    return [kernel * scale, beta + (bias - K.get_value(bn.moving_mean)) * scale]
 
 
 class ResnetBuilder(object):
     @staticmethod
-    def build(input_shape, num_outputs, repetitions, mid_f = [64, 128, 256, 512], output_f=[256, 512, 1024, 2048], block_fn='resnet'):
+    def build(input_shape, num_outputs, repetitions, mid_f = [64, 128, 256, 512], output_f=[256, 512, 1024, 2048], block_fn='resnet',
+              accum_steps=1):
         """Builds a custom ResNet like architecture.
         Args:
-            input_shape: The input shape in the form (nb_channels, nb_rows, nb_cols)
+            input_shape: The input shape in the form (nb_rows, nb_cols, nb_channels)
             num_outputs: The number of outputs at final softmax layer
-            block_fn: The block function to use. This is either `basic_block` or `bottleneck`.
-                The original paper used basic_block for layers < 50
+            block_fn: The residual blocks to use, a key of `_BLOCK_REGISTRY`: `resnet`, `xresnet` or `dresnet`
+                (`xresnext` and `dresnext` are aliases).
             repetitions: Number of repetitions of various block units.
                 At each block unit, the number of filters are doubled and the input size is halved
+            accum_steps: Number of micro-batches each training batch is split into
         Returns:
-            The keras `Model`.
+            The keras `GradientAccumulationModel`.
         """
         if len(input_shape) != 3:
-            raise Exception("Input shape should be a tuple (nb_channels, nb_rows, nb_cols)")
-
-        # Permute dimension order if necessary
-        #if K.image_dim_ordering() == 'tf':
-        #    input_shape = (input_shape[1], input_shape[2], input_shape[0])
-
-        # Load function from str if needed.
-        if block_fn == 'xresnet':
-            id_block = xresneXt_identity_block
-            conv_block = xresneXt_convolution_block
-        elif block_fn == 'dresnet':
-            id_block = dresneXt_identity_block
-            conv_block = dresneXt_convolution_block
-        else:
-            id_block = resnet_identity_block
-            conv_block = resnet_convolution_block
+            raise Exception("Input shape should be a tuple (nb_rows, nb_cols, nb_channels)")
+        if K.image_data_format() != 'channels_last':
+            raise Exception("ResnetBuilder only supports the channels_last data format")
+
+        if block_fn not in _BLOCK_REGISTRY:
+            raise ValueError('Invalid block_fn {}, expected one of {}'.format(block_fn, sorted(_BLOCK_REGISTRY)))
+        id_block, conv_block = _BLOCK_REGISTRY[block_fn]
 
         print('the input shape: {}'.format(input_shape))
         input = Input(shape=input_shape)
@@ -133,48 +158,111 @@ class ResnetBuilder(object):
         #pool1 = MaxPooling2D(pool_size=(3, 3), strides=(2, 2), padding="same")(conv1)
 
         block = conv1
-        #filters = 64
         print('input before reisdual', block.shape)
-        for i, r in enumerate(repetitions):
-            if i == 0:
-                block = _residual_block(block, id_block=id_block, conv_block=conv_block, stage=i,
-                                        mid_f=mid_f[i], output_f=output_f[i], repetitions=r, is_first_layer=True)
-            else:
-                block = _residual_block(block, id_block=id_block, conv_block=conv_block, stage=i,
-                                        mid_f=mid_f[i], output_f=output_f[i], repetitions=r, is_first_layer=False)
-
+        # (mid filters, output filters, repetitions, is first stage) of every stage, fixed before tracing
+        stage_cfg = tuple((mid_f[i], output_f[i], r, i == 0) for i, r in enumerate(repetitions))
+        for stage, (mid, out, reps, first) in enumerate(stage_cfg):
+            block = _residual_block(block, id_block=id_block, conv_block=conv_block, stage=stage,
+                                    mid_f=mid, output_f=out, repetitions=reps, is_first_layer=first)
 
         # Last activation
         block = _bn_relu(block)
 
         # Classifier block
-        block_shape = K.int_shape(block)
+        pool2 = GlobalAveragePooling2D()(block)
+        # Keep the logits and softmax in float32 under a mixed precision policy
+        dense = Dense(num_outputs, kernel_initializer='he_normal', dtype='float32')(pool2)
+        dense = Activation('softmax', name='Softmax', dtype='float32')(dense)
 
-        pool2 = AveragePooling2D(pool_size=(block_shape[1], block_shape[2]),
-                                 strides=(1, 1))(block)
-        flatten1 = Flatten()(pool2)
-        dense = Dense(num_outputs)(flatten1)
-        dense = Activation('softmax', name='Softmax')(dense)
-
-        model = Model(inputs=input, outputs=dense)
+        model = GradientAccumulationModel(inputs=input, outputs=dense, accum_steps=accum_steps)
         return model
 
     @staticmethod
-    def build_resnet_18(input_shape, num_outputs, block_fun):
-        return ResnetBuilder.build(input_shape, num_outputs, [2, 2, 2, 2], block_fn=block_fun)
+    def build_keras_resnet(input_shape, num_outputs, depth, accum_steps=1):
+        """Builds the stock keras.applications ResNet, which maps onto the tuned cuDNN kernels.
+        Args:
+            input_shape: The input shape in the form (nb_rows, nb_cols, nb_channels)
+            num_outputs: The number of outputs at final softmax layer
+            depth: One of 50, 101 or 152
+            accum_steps: Number of micro-batches each training batch is split into
+        Returns:
+            The keras `GradientAccumulationModel`, with the same float32 classifier head as `build`.
+        """
+        base = _KERAS_RESNETS[depth](include_top=False, weights=None, input_shape=input_shape, pooling='avg')
+        dense = Dense(num_outputs, dtype='float32')(base.output)
+        dense = Activation('softmax', name='Softmax', dtype='float32')(dense)
+        return GradientAccumulationModel(inputs=base.input, outputs=dense, accum_steps=accum_steps)
+
+    @staticmethod
+    def weight_decay_variables(model):
+        """Returns the kernels the optimizer weight decay replaces the l2 regularizer on.
+        Only the convs of `_conv_bn_relu` and `_bn_relu_conv` were regularized, every other
+        variable has to be excluded from the decay.
+        """
+        return [layer.kernel for layer in model.layers if getattr(layer, 'decay_kernel', False)]
+
+    @staticmethod
+    def fuse_bn(model):
+        """Folds every BatchNormalization that directly follows a Conv2D into that conv.
+        Only valid for inference, the training graph is left untouched.
+        Args:
+            model: The trained keras `Model`.
+        Returns:
+            A new keras `Model` with the folded BN layers replaced by linear activations.
+        """
+        layer_cfgs = model.get_config()['layers']
+        consumers = {}
+        for layer_cfg in layer_cfgs:
+            for node in layer_cfg['inbound_nodes']:
+                for inbound in node:
+                    consumers[inbound[0]] = consumers.get(inbound[0], 0) + 1
+
+        # conv name -> BN layer, only when the conv output feeds nothing but the BN
+        fused = {}
+        for layer_cfg in layer_cfgs:
+            nodes = layer_cfg['inbound_nodes']
+            if layer_cfg['class_name'] != 'BatchNormalization' or len(nodes) != 1 or len(nodes[0]) != 1:
+                continue
+            bn = model.get_layer(layer_cfg['config']['name'])
+            conv = model.get_layer(nodes[0][0][0])
+            if isinstance(conv, Conv2D) and consumers[conv.name] == 1 and bn.axis in ([-1], [CHANNEL_AXIS]):
+                fused[conv.name] = bn
+        folded_bn = set(bn.name for bn in fused.values())
+
+        def clone_layer(layer):
+            config = layer.get_config()
+            if layer.name in fused:
+                config['use_bias'] = True
+            elif layer.name in folded_bn:
+                return Activation('linear', name=layer.name, dtype=layer.dtype_policy)
+            return layer.__class__.from_config(config)
+
+        fused_model = clone_model(model, clone_function=clone_layer)
+        for layer in model.layers:
+            if layer.name in folded_bn:
+                continue
+            weights = layer.get_weights()
+            if layer.name in fused:
+                weights = _fold_bn(layer, fused[layer.name])
+            fused_model.get_layer(layer.name).set_weights(weights)
+        return fused_model
+
+    @staticmethod
+    def build_resnet_18(input_shape, num_outputs, block_fun, accum_steps=1):
+        return ResnetBuilder.build(input_shape, num_outputs, [2, 2, 2, 2], block_fn=block_fun, accum_steps=accum_steps)
 
     @staticmethod
-    def build_resnet_34(input_shape, num_outputs, block_fun):
-        return ResnetBuilder.build(input_shape, num_outputs, [3, 4, 6, 3], block_fn=block_fun)
+    def build_resnet_34(input_shape, num_outputs, block_fun, accum_steps=1):
+        return ResnetBuilder.build(input_shape, num_outputs, [3, 4, 6, 3], block_fn=block_fun, accum_steps=accum_steps)
 
     @staticmethod
-    def build_resnet_50(input_shape, num_outputs, block_fun):
-        return ResnetBuilder.build(input_shape, num_outputs, [3, 4, 6, 3], block_fn=block_fun)
+    def build_resnet_50(input_shape, num_outputs, block_fun, accum_steps=1):
+        return ResnetBuilder.build(input_shape, num_outputs, [3, 4, 6, 3], block_fn=block_fun, accum_steps=accum_steps)
 
     @staticmethod
-    def build_resnet_101(input_shape, num_outputs, block_fun):
-        return ResnetBuilder.build(input_shape, num_outputs, [3, 4, 23, 3], block_fn=block_fun)
+    def build_resnet_101(input_shape, num_outputs, block_fun, accum_steps=1):
+        return ResnetBuilder.build(input_shape, num_outputs, [3, 4, 23, 3], block_fn=block_fun, accum_steps=accum_steps)
 
     @staticmethod
-    def build_resnet_152(input_shape, num_outputs, block_fun):
-        return ResnetBuilder.build(input_shape, num_outputs, [3, 8, 36, 3], block_fn=block_fun)
\ No newline at end of file
+    def build_resnet_152(input_shape, num_outputs, block_fun, accum_steps=1):
+        return ResnetBuilder.build(input_shape, num_outputs, [3, 8, 36, 3], block_fn=block_fun, accum_steps=accum_steps)
\ No newline at end of file
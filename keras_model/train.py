@@ -1,12 +1,27 @@
-from keras.preprocessing.image import ImageDataGenerator
-from keras.callbacks import TensorBoard, ReduceLROnPlateau, ModelCheckpoint, EarlyStopping
-from keras.optimizers import SGD
-#from mainpath import ROOT_DIR
+import os
+# XLA auto-clustering is read when TensorFlow initializes, so set it before importing keras
+os.environ.setdefault('TF_XLA_FLAGS', '--tf_xla_auto_jit=2')
+
+import tensorflow as tf
+from keras import mixed_precision
+from keras import backend as K
 from keras_config import Config
-from resnet import ResnetBuilder
-from keras_loss import cls_cross_entropy
 
-import os
+# Grow the BFC pool on demand instead of reserving every GPU upfront
+for gpu in tf.config.list_physical_devices('GPU'):
+    tf.config.experimental.set_memory_growth(gpu, True)
+tf.config.optimizer.set_jit(True)
+K.set_image_data_format('channels_last')
+
+# The policy has to be set before any layer is built, so keep this above the resnet import.
+mixed_precision.set_global_policy(Config.precision)
+
+from keras.callbacks import TensorBoard, ReduceLROnPlateau, ModelCheckpoint, EarlyStopping, BackupAndRestore
+from keras.optimizers.experimental import SGD
+#from mainpath import ROOT_DIR
+from resnet import ResnetBuilder, USE_WEIGHT_DECAY_OPTIMIZER
+from keras_data import load_dataset
+from keras_loss import cls_cross_entropy
 
 ROOT_DIR = os.getcwd()
 if ROOT_DIR.endswith('keras_model'):
@@ -24,53 +39,78 @@ hyper = Config.backbone
 tensorboard = TensorBoard(os.path.join(keras_tb, hyper))
 early_stopping = EarlyStopping(monitor='val_loss',patience=5, min_delta=0.001)
 lr_reduce = ReduceLROnPlateau(monitor='loss',patience=20,verbose=1)
-checkpoint = ModelCheckpoint(os.path.join(ROOT_DIR, 'keras_model', 'ckpt', hyper + '.h5'), period=1,save_best_only=True, monitor='val_acc')
-callbacks = [tensorboard,lr_reduce,checkpoint]
-batch_size = Config.image_per_gpu * Config.gpu_count
+# Weights only, the graph is rebuilt from ResnetBuilder anyway
+checkpoint = ModelCheckpoint(os.path.join(ckpt_keras, hyper + '-{epoch:03d}.weights.h5'), save_weights_only=True,
+                             save_best_only=True, monitor='val_acc', save_freq='epoch')
+backup = BackupAndRestore(os.path.join(ckpt_keras, hyper + '_backup'))
+callbacks = [tensorboard,lr_reduce,checkpoint,backup]
 
-num_output = 8
-if Config.backbone == 'resnet50':
-    base_model = ResnetBuilder.build_resnet_50(input_shape=(224,224,3), num_outputs=num_output, block_fun='resnet')
-if Config.backbone == 'resnet101':
-    base_model = ResnetBuilder.build_resnet_101(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='resnet')
-if Config.backbone == 'resnet152':
-    base_model = ResnetBuilder.build_resnet_152(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='resnet')
+# Replicate the model on the first gpu_count GPUs, falls back to the CPU when none is visible
+gpus = tf.config.list_logical_devices('GPU')[:Config.gpu_count]
+strategy = tf.distribute.MirroredStrategy([gpu.name for gpu in gpus] or None)
+# Each replica sees accum_steps micro-batches of image_per_gpu images per update
+batch_size = Config.image_per_gpu * Config.accum_steps * strategy.num_replicas_in_sync
 
-if Config.backbone == 'xresnet50':
-    base_model = ResnetBuilder.build_resnet_50(input_shape=(224,224,3), num_outputs=num_output, block_fun='xresnet')
-if Config.backbone == 'xresnet101':
-    base_model = ResnetBuilder.build_resnet_101(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='xresnet')
-if Config.backbone == 'xresnet152':
-    base_model = ResnetBuilder.build_resnet_152(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='xresnet')
+num_output = 8
+with strategy.scope():
+    if Config.backbone == 'resnet50':
+        base_model = ResnetBuilder.build_keras_resnet(input_shape=(224,224,3), num_outputs=num_output, depth=50,
+                                                      accum_steps=Config.accum_steps)
+    if Config.backbone == 'resnet101':
+        base_model = ResnetBuilder.build_keras_resnet(input_shape=(224, 224, 3), num_outputs=num_output, depth=101,
+                                                      accum_steps=Config.accum_steps)
+    if Config.backbone == 'resnet152':
+        base_model = ResnetBuilder.build_keras_resnet(input_shape=(224, 224, 3), num_outputs=num_output, depth=152,
+                                                      accum_steps=Config.accum_steps)
 
-if Config.backbone == 'dresnet50':
-    base_model = ResnetBuilder.build_resnet_50(input_shape=(224,224,3), num_outputs=num_output, block_fun='dresnet')
-if Config.backbone == 'dresnet101':
-    base_model = ResnetBuilder.build_resnet_101(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='dresnet')
-if Config.backbone == 'dresnet152':
-    base_model = ResnetBuilder.build_resnet_152(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='dresnet')
-base_model.summary()
+    if Config.backbone == 'xresnet50':
+        base_model = ResnetBuilder.build_resnet_50(input_shape=(224,224,3), num_outputs=num_output, block_fun='xresnet',
+                                                   accum_steps=Config.accum_steps)
+    if Config.backbone == 'xresnet101':
+        base_model = ResnetBuilder.build_resnet_101(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='xresnet',
+                                                    accum_steps=Config.accum_steps)
+    if Config.backbone == 'xresnet152':
+        base_model = ResnetBuilder.build_resnet_152(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='xresnet',
+                                                    accum_steps=Config.accum_steps)
 
+    if Config.backbone == 'dresnet50':
+        base_model = ResnetBuilder.build_resnet_50(input_shape=(224,224,3), num_outputs=num_output, block_fun='dresnet',
+                                                   accum_steps=Config.accum_steps)
+    if Config.backbone == 'dresnet101':
+        base_model = ResnetBuilder.build_resnet_101(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='dresnet',
+                                                    accum_steps=Config.accum_steps)
+    if Config.backbone == 'dresnet152':
+        base_model = ResnetBuilder.build_resnet_152(input_shape=(224, 224, 3), num_outputs=num_output, block_fun='dresnet',
+                                                    accum_steps=Config.accum_steps)
+    base_model.summary()
 
-loss = cls_cross_entropy()
-optimizer = SGD(lr=Config.lr, momentum=0.9, decay=0.00001, nesterov=True)
-train_gen = ImageDataGenerator(samplewise_center=True, samplewise_std_normalization=True, rotation_range=10,
-                               width_shift_range=0.1, height_shift_range=0.1, shear_range=10, zoom_range=0.1,
-                               fill_mode='reflect', horizontal_flip=True, vertical_flip=True)
-val_gen = ImageDataGenerator(samplewise_center=True, samplewise_std_normalization=True)
-train_data = train_gen.flow_from_directory(TRAIN_OPEN_DIR, target_size=(224,224), batch_size=batch_size, shuffle=True, color_mode='rgb')
-val_data = val_gen.flow_from_directory(VALID_OPEN_DIR, target_size=(224,224), batch_size=batch_size, shuffle=True, color_mode='rgb')
+    loss = cls_cross_entropy()
+    optimizer = SGD(learning_rate=Config.lr, momentum=0.9, nesterov=True,
+                    weight_decay=1e-4 if USE_WEIGHT_DECAY_OPTIMIZER else None)
+    # Decay only the kernels that used to carry the l2(1e-4) regularizer.
+    # The legacy decay=1e-5 time based lr decay has no equivalent on this optimizer, ReduceLROnPlateau
+    # needs a plain float learning rate, so the lr is only lowered on plateaus now
+    decayed = set(id(v) for v in ResnetBuilder.weight_decay_variables(base_model))
+    optimizer.exclude_from_weight_decay(var_list=[v for v in base_model.trainable_variables if id(v) not in decayed])
+    if Config.precision == 'mixed_float16':
+        # bfloat16 shares the float32 exponent range, only float16 needs loss scaling
+        optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+    base_model.compile(optimizer=optimizer, loss='categorical_crossentropy', metrics=['acc'], jit_compile=True,
+                       steps_per_execution=Config.steps_per_execution)
 
-train_step_per_epoch = len(train_data)/batch_size
-valid_step_per_epoch = len(val_data)/batch_size
+# fit distributes the datasets over the replicas, its multi device iterator already copies the
+# next batch onto every GPU, so prefetch_to_device (which must stay the last stage) is not used
+train_ds = load_dataset(TRAIN_OPEN_DIR, batch_size, training=True, cache_dir=Config.cache_dir,
+                        shuffle_buffer=Config.shuffle_buffer)
+val_ds = load_dataset(VALID_OPEN_DIR, batch_size, cache_dir=Config.cache_dir)
 
-base_model.compile(optimizer=optimizer, loss='categorical_crossentropy', metrics=['acc'])
-base_model.fit_generator(train_data, steps_per_epoch=train_step_per_epoch,
-                         epochs=200,callbacks=callbacks,
-                         validation_data=val_data,validation_steps=valid_step_per_epoch)
+base_model.fit(train_ds, epochs=200, callbacks=callbacks, validation_data=val_ds)
 
 model_json = base_model.to_json()
 with open(os.path.join(json_keras, hyper + '.json'), 'w') as json_file:
     json_file.write(model_json)
 base_model.save_weights(os.path.join(weights_keras, hyper + '.h5'))
+# Deployment copy with the BN layers folded into their convs
+fused_model = ResnetBuilder.fuse_bn(base_model)
+fused_model.save(os.path.join(weights_keras, hyper + '_fused.h5'))
 print(hyper + 'has been saved')
\ No newline at end of file
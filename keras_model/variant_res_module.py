@@ -1,6 +1,4 @@
-from keras.layers.convolutional import Conv2D
-from keras.layers import Activation, Add
-from keras.layers.normalization import BatchNormalization
+from keras.layers import Conv2D, Activation, Add, BatchNormalization
 import numpy as np
 ###########################################
 # ResNet Graph
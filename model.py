@@ -30,7 +30,9 @@ val_gen = ImageDataGenerator(samplewise_center=True, samplewise_std_normalizatio
 train_data = train_gen.flow_from_directory('./zht_train', target_size=(224,224), batch_size=16)
 val_data = val_gen.flow_from_directory('./zht_val', target_size=(224,224), batch_size=16)
 model.compile(optimizer='sgd', loss='categorical_crossentropy', metrics=['acc'])
-model.fit_generator(train_data, steps_per_epoch=88,epochs=200,callbacks=callbacks,validation_data=val_data,validation_steps=13)
+# fit takes the number of batches per epoch from len() of the iterators
+model.fit(train_data, epochs=200, callbacks=callbacks, validation_data=val_data,
+          workers=os.cpu_count(), use_multiprocessing=True)
 
 '''
 path = './val'